@@ -0,0 +1,170 @@
+#!BPY
+
+"""
+Name: 'The Movies (.msh) folder batch...'
+Blender: 246
+Group: 'Import'
+Tooltip: 'Import every msh file of a folder from Lionhead Studios The Movies. (.msh)'
+"""
+
+__author__ = ["Glen Rickey, Nick Hudson, Mark S Andrews"]
+__url__ = ("Director's Cut Modding Foundry","http://www.dcmodding.com")
+__version__ = "1.00 04-05-2009"
+__bpydoc__ = """\
+
+Msh Batch Importer
+
+Imports all msh files of a folder (pick any one of them in the file
+selector) into the current scene, for example the pieces of a facility
+or a lot.
+
+The files are decoded in parallel by worker processes running
+msh_reader.py, and built into Blender objects one after another, in
+file name order, on the main thread while the workers carry on.  If no
+worker processes can be started the files are decoded here, one at a
+time.  Textures and materials several files share are only loaded
+once.
+
+On Windows the workers need a separate Python 2.6 (python.exe), since
+Blender itself can't be started as one.  It is looked for next to the
+Python Blender uses and on the PATH.
+
+"""
+
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# Script copyright (C) Mark S Andrews, Nick Hudson, Glen Rickey
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+# --------------------------------------------------------------------------
+
+
+# Import modules
+
+import Blender
+import os, sys
+from itertools import izip
+import msh_reader
+import msh_import
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+
+#***********************************************
+# helper functions
+#***********************************************
+
+def msh_files(paths):
+    '''The msh files of a folder, or of a list of files, in name order.'''
+    if isinstance(paths, basestring):
+        paths = [os.path.join(paths, f) for f in os.listdir(paths)]
+    files = [p for p in paths if p.lower().endswith(".msh")]
+    files.sort()
+    return files
+
+def python_executable():
+    '''The python.exe worker processes are started with on Windows, None
+    where they are forked or when there is none.'''
+    if os.name != "nt":
+        return None
+    dirs = [sys.exec_prefix, sys.prefix]
+    dirs += os.environ.get("PATH", "").split(os.pathsep)
+    for dir in dirs:
+        p = os.path.join(dir, "python.exe")
+        if os.path.isfile(p):
+            return p
+    return None
+
+def start_pool(processes=None):
+    # None if worker processes aren't available
+    if multiprocessing is None:
+        return None
+    if os.name == "nt":
+        executable = python_executable()
+        if executable is None:
+            return None
+        multiprocessing.set_executable(executable)
+    try:
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        print 'decoding in %d processes' % processes
+        return multiprocessing.Pool(processes)
+    except (OSError, ImportError, NotImplementedError), e:
+        print "FAIL! Can't start worker processes (%s), decoding here." % e
+        return None
+
+#***********************************************
+# batch import
+#***********************************************
+
+def batch_import(paths, processes=None, preview=None):
+    '''Imports the msh files of a folder, or a list of msh files.
+
+    processes is the number of worker processes, by default one per
+    processor.  preview is passed on to msh_import.load_msh.
+    '''
+    start_time = Blender.sys.time()
+    files = msh_files(paths)
+    if not files:
+        print "FAIL! No msh files found"
+        return
+
+    # previews only decode what the stand-in meshes need
+    parse = msh_reader.parse_msh
+    if preview is not None:
+        parse = msh_reader.parse_msh_preview
+    pool = None
+    if len(files) > 1:
+        pool = start_pool(processes)
+    if pool is not None:
+        models = pool.imap(parse, files)
+    else:
+        models = (parse(f) for f in files)
+
+    # images and materials the files have in common are made once
+    cache = msh_import.import_cache()
+    try:
+        # each model is built as soon as it arrives, in file order
+        for filename, model in izip(files, models):
+            if isinstance(model, basestring):
+                print 'FAIL! %s: "%s"' % (model, filename)
+                continue
+            msh_import.load_msh(filename, model=model, cache=cache,
+                preview=preview)
+    except:
+        # don't wait for the workers to decode the rest
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print 'finished batch import of %d files in %.4f sec.' % (len(files),
+        Blender.sys.time()-start_time)
+
+#***********************************************
+# register callback
+#***********************************************
+def my_callback(filename):
+    batch_import(os.path.dirname(filename))
+
+if __name__ == '__main__':
+    Blender.Window.FileSelector(my_callback, "Import MSH folder", '*.msh')
@@ -55,7 +55,10 @@ from Blender import Image, Material, Texture, NMesh, Window, Armature, Group
 from Blender.Mathutils import Matrix, Vector
 from random import randint
 import struct, os, re
+from array import array
 import tmConst
+import msh_records
+from msh_records import matrix_fields
 
 #***********************************************
 # globals
@@ -63,6 +66,7 @@ import tmConst
 
 material_list = []
 material_keys = []
+world_verts = {}
 
 unnamed_group = re.compile(r"(\d{2})(\.\d+)?")
 static_anim_group = re.compile(r".?_[sc]a_")
@@ -80,15 +84,34 @@ def write_nts(item, stream, length=32):
         print "ITEM: %s" % (item)
         print "LEN: %d" % (len(item))
         raise ValueError("%s is longer than %d"%(item, length))
-    while len(item) < length:
-        item += "\x00"
-    stream.write(item)
+    stream.write(item + "\x00" * (length - len(item)))
 
 def write_null(struct_type, stream):
-    data = ""
-    for b in range(struct.calcsize(struct_type)):
-        data += "\x00"
-    stream.write(data)
+    stream.write("\x00" * struct.calcsize("<" + struct_type))
+
+class section_writer(object):
+    '''Collects the bytes of a section of the file, for flush() to write
+    in one go.  It stands in for the file in the writer functions.
+    reserve() writes a placeholder for a field that is only known later,
+    patch() fills it in.'''
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def reserve(self, data):
+        self.chunks.append(data)
+        return len(self.chunks) - 1
+
+    def patch(self, mark, data):
+        if len(data) != len(self.chunks[mark]):
+            raise ValueError("patch doesn't fit its placeholder")
+        self.chunks[mark] = data
+
+    def flush(self, stream):
+        stream.write("".join(self.chunks))
+        self.chunks = []
 
 
 class range_adjust(object):
@@ -96,11 +119,19 @@ class range_adjust(object):
         self.min = min
         self.max = max
         self.range = abs(self.max - self.min)
+        if self.range:
+            self.scale = 65535.0 / self.range
     def adjust(self, value):
         if self.range == 0:
             return 0
-        scale = 65535.0 / self.range
-        return int((value - self.min) * scale)
+        return int((value - self.min) * self.scale)
+    def adjust_all(self, values):
+        # adjust() of every value
+        if self.range == 0:
+            return [0] * len(values)
+        low = self.min
+        scale = self.scale
+        return [int((v - low) * scale) for v in values]
     
 def getNeckIndex(point, snap_points):
         '''
@@ -123,17 +154,31 @@ def getNeckIndex(point, snap_points):
                                 close_vec= v
         return snap_points.index(close_vec)
     
-def adjustBounds(obj):
-    mat = obj.mat  
-    if obj.getType() == 'Mesh':
+def world_positions(obj):
+    '''The world space x, y and z lists of the verts of mesh object obj.
+    They are worked out once per export, for the bounds and for
+    write_mesh.'''
+    if obj.name not in world_verts:
+        mat = obj.mat
         msh = obj.getData(0,1)
+        # Blender 2.49 has no bulk access to vertex coordinates, and
+        # Mesh.transform() would change the mesh and round differently.
+        # So each vert still goes through Vector * Matrix, which keeps
+        # the written bytes the same, but only once per object.
         worldverts = [(x.co * mat) for x in msh.verts]
-        xMin = min([x[0] for x in worldverts])
-        xMax = max([x[0] for x in worldverts])
-        yMin = min([y[1] for y in worldverts])
-        yMax = max([y[1] for y in worldverts])
-        zMin = min([z[2] for z in worldverts])
-        zMax = max([z[2] for z in worldverts])
+        world_verts[obj.name] = ([x[0] for x in worldverts],
+            [y[1] for y in worldverts], [z[2] for z in worldverts])
+    return world_verts[obj.name]
+
+def adjustBounds(obj):
+    if obj.getType() == 'Mesh':
+        xs, ys, zs = world_positions(obj)
+        xMin = min(xs)
+        xMax = max(xs)
+        yMin = min(ys)
+        yMax = max(ys)
+        zMin = min(zs)
+        zMax = max(zs)
         
         return [
                 min([xMin, Bounds[0]]),
@@ -167,11 +212,80 @@ def calc_bbox(bounds_list):
     return [xMin, xMax, yMin, yMax, zMin, zMax] 
 
 
-class triface(object):
-    def __init__(self, vindex=(0,0,0), faceuvs=None, lmuvs=None):
-        self.vertex_index = vindex
-        self.faceuvs = faceuvs
-        self.lmuvs = lmuvs
+def bone_palette(names):
+    '''{bone name: index} for the bone order list names.  A name listed
+    twice keeps its first index, as list.index() would give.'''
+    palette = {}
+    for i, name in enumerate(names):
+        palette.setdefault(name, i)
+    return palette
+
+def split_vertices(used, corners):
+    '''Splits the verts of a mesh along its uv (and lightmap) seams.
+
+    used are the indices of the verts in faces, sorted, and corners the
+    (vert index, quantized uvs) of each face corner.  Every distinct
+    corner becomes one output vert: the first one of a vert keeps its
+    place among the used verts, later ones are appended in the order they
+    turn up.  Returns (index_list, rows, uvs, copies): the output vert of
+    each corner, the place in used of each output vert's source vert,
+    the uvs of each output vert and {vert index: [its output verts]}.
+    '''
+    rank = {}
+    for row, i in enumerate(used):
+        rank[i] = row
+    rows = range(len(used))
+    uvs = [None] * len(used)
+    copies = {}
+    slots = {}
+    index_list = []
+    for corner in corners:
+        k = slots.get(corner)
+        if k is None:
+            i, uv = corner
+            k = rank[i]
+            if uvs[k] is None:
+                uvs[k] = uv
+                copies[i] = [k]
+            else:
+                k = len(rows)
+                rows.append(rank[i])
+                uvs.append(uv)
+                copies[i].append(k)
+            slots[corner] = k
+        index_list.append(k)
+    return index_list, rows, uvs, copies
+
+# corners of a face in triangle order, quads are split in two
+TRIANGLE = (0, 1, 2)
+QUAD = (0, 1, 2, 0, 2, 3)
+
+def corner_verts(faces):
+    '''The vert index of every triangle corner of faces.'''
+    corners = []
+    for face in faces:
+        f_v = face.v
+        if len(f_v) == 3:
+            corners.extend([f_v[0].index, f_v[1].index, f_v[2].index])
+        else:
+            corners.extend([f_v[k].index for k in QUAD])
+    return corners
+
+def corner_uvs(mesh, layer):
+    '''The u and v lists of every triangle corner on uv layer of mesh.'''
+    mesh.activeUVLayer = layer
+    us = []
+    vs = []
+    for face in mesh.faces:
+        f_uv = face.uv
+        if len(f_uv) == 3:
+            order = TRIANGLE
+        else:
+            order = QUAD
+        for k in order:
+            us.append(f_uv[k][0])
+            vs.append(f_uv[k][1])
+    return us, vs
     
 
 #***********************************************
@@ -201,9 +315,6 @@ def write_material(mat, stream):
         if im:
             i[3] = image_list.index(im)
     
-    # *********** write image refs *************
-    stream.write(struct.pack("bbbb", i[0], i[1], i[2], i[3]))
-    
     #  Material Flags
     matflags0 = 0
     matflags1 = 4 #mesh always has UV
@@ -238,17 +349,27 @@ def write_material(mat, stream):
         matscrollV = mat.properties['TheMovies']['scroll_V'] % 256
         matrotUV = mat.properties['TheMovies']['rot_UV'] % 256
     
-    # write Material Flags
-    stream.write(struct.pack("B",matflags0))
-    for flag in matflaglist:
-        stream.write(struct.pack("B", flag))
-    stream.write(struct.pack("B", matflags1))
-    stream.write("\x00") #padding
-    # write material color
-    stream.write(struct.pack("BBBB", int(mat.B * 255), int(mat.G * 255), int(mat.R * 255), int(mat.alpha * 255)))
-    # write material scroll properties
-    stream.write(struct.pack("BBB", matscrollU, matscrollV, matrotUV))
-    stream.write("\x00") #padding
+    # *********** write image refs, flags, color and scroll *************
+    stream.write(msh_records.material.pack(
+        map0 = i[0], map1 = i[1], map2 = i[2], map3 = i[3],
+        flags0 = matflags0,
+        wrap_U = matflaglist[0],
+        wrap_V = matflaglist[1],
+        use_alpha = matflaglist[2],
+        enable_alpha_test = matflaglist[3],
+        glass = matflaglist[4],
+        water = matflaglist[5],
+        still_water = matflaglist[6],
+        alpha_per_vertex = matflaglist[7],
+        alphaenvmap = matflaglist[8],
+        flags1 = matflags1,
+        color_B = int(mat.B * 255),
+        color_G = int(mat.G * 255),
+        color_R = int(mat.R * 255),
+        color_A = int(mat.alpha * 255),
+        scroll_U = matscrollU,
+        scroll_V = matscrollV,
+        rot_UV = matrotUV))
 
 #***********************************************
 # Write the control meshes in the correct order.
@@ -285,21 +406,23 @@ def write_basic_mesh(mesh, stream):
 
     meshdata = mesh.getData()
     
-    # ********** write vertex count ************
-    stream.write(struct.pack("L",len(meshdata.verts)))
-    # stream.write(len(mesh.verts))
-    # ********** write face count **************
-    stream.write(struct.pack("L",len(meshdata.faces)))
-    #stream.write(len(mesh.faces))
+    # vertex positions and face vertices as flat arrays, each written
+    # in one go
+    positions = array("f")
     for v in meshdata.verts:
-        # ******* write vertex position ********
-        stream.write(struct.pack("fff", v.co[0], v.co[1], v.co[2]))
+        co = v.co
+        positions.extend((co[0], co[1], co[2]))
+    indices = array("H")
     for f in meshdata.faces:
-        v0 = meshdata.verts.index(f.v[0])
-        v1 = meshdata.verts.index(f.v[1])
-        v2 = meshdata.verts.index(f.v[2])
-        # ******** write face vertices *********
-        stream.write(struct.pack("HHH", v0, v1, v2))
+        fv = f.v
+        indices.extend((fv[0].index, fv[1].index, fv[2].index))
+
+    # ********** write vertex and face count ************
+    stream.write(struct.pack("<LL", len(meshdata.verts), len(meshdata.faces)))
+    # ******* write vertex positions ********
+    stream.write(positions.tostring())
+    # ******** write face vertices *********
+    stream.write(indices.tostring())
     if len(meshdata.faces) & 1:
         # ********** write pad bytes ***********
         stream.write("\x00\x00")
@@ -330,14 +453,12 @@ def write_group(grp, stream):
         if ob.getType() == "Mesh":
             meshes.append(ob)
         
-    # *********** write group header ***********
-    stream.write(struct.pack("BBBB", len(meshes), 0, grpflags1, grpflags2))
-    # ************** write matrix **************
-    for p in range(4):
-        stream.write(struct.pack("fff", pivot[p][0], pivot[p][1], pivot[p][2]))
+    # ******* write group header and matrix *******
+    stream.write(msh_records.group_header.pack(mesh_count = len(meshes),
+        flags1 = grpflags1, flags2 = grpflags2, **matrix_fields(pivot)))
     
     if has_hidden:
-        stream.write(struct.pack("HH", hidden_on, hidden_off))
+        stream.write(struct.pack("<HH", hidden_on, hidden_off))
         
     for m in meshes:
         write_mesh(m, stream)
@@ -405,76 +526,28 @@ def write_mesh(ob, stream):
     meshflags1 |= has_meshid * 16
     meshflags1 |= has_neckconnect * 64
     mat = mesh.getMaterials()
-    # Start Writin' !!
-    # ********** write material index **********
     if mat:
-        stream.write(struct.pack("L",material_keys.index(mat[0].name)))
+        materialid = material_keys.index(mat[0].name)
     else:
-        write_null("L", stream)
+        materialid = 0
 
-    #Get all faces
-    face_list = []
+    #Get all faces, as triangle corners
     has_uv = mobj.faceUV
-    
-    if not has_uv:
-        face_uv = None
-    
-    for face in mobj.faces:
-        f_v = face.v
-
-        if len(f_v)==3:
-            new_face = triface((f_v[0].index, f_v[1].index, f_v[2].index))
-            if (has_uv): 
-                mobj.activeUVLayer = 'UVTex'
-                f_uv = face.uv
-                new_face.faceuvs = f_uv[0], f_uv[1],f_uv[2]
-            if (has_lightmap):
-                mobj.activeUVLayer = 'LightMap'
-                f_uv = face.uv
-                new_face.lmuvs = f_uv[0], f_uv[1], f_uv[2]
-            face_list.append(new_face)
-        
-        else: #face is a quad, triangulate it!
-            new_face = triface((f_v[0].index, f_v[1].index, f_v[2].index))
-            new_face_2 = triface((f_v[0].index, f_v[2].index, f_v[3].index))
-            
-            if (has_uv):
-                mobj.activeUVLayer = 'UVTex'
-                f_uv = face.uv
-                new_face.faceuvs = f_uv[0], f_uv[1], f_uv[2]
-                new_face_2.faceuvs = f_uv[0], f_uv[2], f_uv[3]
-            if (has_lightmap):
-                mobj.activeUVLayer = 'LightMap'
-                f_uv = face.uv
-                new_face.lmuvs = f_uv[0], f_uv[1], f_uv[2]
-                new_face_2.lmuvs = f_uv[0], f_uv[2], f_uv[3]
-            
-            face_list.append( new_face )
-            face_list.append( new_face_2 )
+    corners = corner_verts(mobj.faces)
+    if has_uv:
+        us, vs = corner_uvs(mobj, 'UVTex')
+    if has_lightmap:
+        lmus, lmvs = corner_uvs(mobj, 'LightMap')
             
     #Process Faces
-    vlist = {}
-    uvlist  =  {}
-    lmuvlist = {}
-    dupverts = {}
-    new_index = 0
-    index_list = []
+    split_time = Blender.sys.time()
     
     #calc ranges 
-
-    tx_min = min([f.faceuvs[i][0] for f in face_list for i in range(3)])
-    tx_max = max([f.faceuvs[i][0] for f in face_list for i in range(3)])
-    ty_min = min([f.faceuvs[i][1] for f in face_list for i in range(3)])
-    ty_max = max([f.faceuvs[i][1] for f in face_list for i in range(3)])
-    txr = range_adjust(tx_min, tx_max)    
-    tyr = range_adjust(ty_min, ty_max)
+    txr = range_adjust(min(us), max(us))
+    tyr = range_adjust(min(vs), max(vs))
     if has_lightmap:
-        lmx_min = min([f.lmuvs[i][0] for f in face_list for i in range(3)])
-        lmx_max = max([f.lmuvs[i][0] for f in face_list for i in range(3)])
-        lmy_min = min([f.lmuvs[i][1] for f in face_list for i in range(3)])
-        lmy_max = max([f.lmuvs[i][1] for f in face_list for i in range(3)])
-        lmxr = range_adjust(lmx_min, lmx_max)
-        lmyr = range_adjust(lmy_min, lmy_max)
+        lmxr = range_adjust(min(lmus), max(lmus))
+        lmyr = range_adjust(min(lmvs), max(lmvs))
     else:
         lmxr = range_adjust(0,0)
         lmyr = range_adjust(0,0) 
@@ -484,222 +557,114 @@ def write_mesh(ob, stream):
     nr = range_adjust(-1.0, 1.0)
     
     # first add all the valid verts (those in actual faces)
-    goodindx = []
-    for tf in mobj.faces:
-        for gv in tf.v:
-            if gv.index not in goodindx:
-                goodindx.append(gv.index)
+    goodindx = list(set(corners))
     goodindx.sort()
-                
-    for vtex in mobj.verts:
-        if vtex.index in goodindx:
-            #multiply by objects' 4x4 matrix to get World Coordinates...
-            vworld = vtex.co * ob.matrix
-            vlist[vtex.index] = [xr.adjust(vworld[0]), \
-                yr.adjust(vworld[1]), \
-                zr.adjust(vworld[2]), \
-                nr.adjust(vtex.no[0]), \
-                nr.adjust(vtex.no[1]), \
-                nr.adjust(vtex.no[2])]
-            #populate the uv / lm lists with spaces
-            uvlist[vtex.index] = []
-            dupverts[vtex.index] = []
-            if (has_lightmap):
-                lmuvlist[vtex.index] = []
-        
-    new_index = max(vlist)+1 #AHA!!
     
-    for f in face_list:
-        for i in range(3):
-
-            uv = [txr.adjust(f.faceuvs[i][0]),tyr.adjust(f.faceuvs[i][1])]
-            v_indx = f.vertex_index[i]
-            if (has_lightmap):
-                lmuv = [lmxr.adjust(f.lmuvs[i][0]),lmyr.adjust(f.lmuvs[i][1])]
-                if uvlist[v_indx] != []:
-                    rootindx = dupverts[v_indx][0]
-                    matches = []
-                    for ckvert in dupverts[v_indx]:
-                        if uvlist[ckvert] == uv:
-                            matches += [ckvert]
-                    if len(matches) == 0:
-                    #must be a new UV!
-                        #duplicate existing vertex
-                        vlist[new_index] = vlist[rootindx]
-                        #add its new uv
-                        uvlist[new_index] = uv
-                        lmuvlist[new_index] = lmuv
-                        #add this index to a list so we can find it later
-                        dupverts[rootindx] += [new_index]
-                        v_indx = new_index
-                        new_index += 1
-                    else:
-                        #Check our lmuvs
-                        if lmuvlist[v_indx] != []:
-                            matched = False
-                            for ckvert in matches:
-                                if lmuvlist[ckvert] == lmuv:
-                                    matched = True
-                                    v_indx = ckvert
-                            if matched == False:
-                            #Must be a new LMUV!
-                                #duplicate this vert/uv
-                                vlist[new_index] = vlist[rootindx]
-                                #add its uv
-                                uvlist[new_index] = uv
-                                lmuvlist[new_index] = lmuv
-                                #add this index to a list so we can find it later
-                                dupverts[rootindx] += [new_index]
-                                v_indx = new_index
-                                new_index += 1
-                        else:
-                            #first time we've seen this.  Add it.
-                            lmuvlist[v_indx] = lmuv
-                        
-                else:
-                    uvlist[v_indx] = uv
-                    dupverts[v_indx] += [v_indx]
-                    if lmuvlist[v_indx] != []:
-                        if lmuvlist[v_indx] != lmuv:
-                        #Must be a new LMUV!
-                            #duplicate this vert/uv
-                            vlist[new_index] = vlist[v_indx]
-                            #add its uv
-                            uvlist[new_index] = uv
-                            lmuvlist[new_index] = lmuv
-                            #add this index to a list so we can find it later
-                            dupverts[v_indx] += [new_index]
-                            v_indx = new_index
-                            new_index += 1
-                        #else:  Do nothing, we're all good!
-                    else:
-                            #first time we've seen this.  Add it.
-                            lmuvlist[v_indx] = lmuv
-                    
-                
-            else:
-                if uvlist[v_indx] != []:
-                    rootindx = dupverts[v_indx][0]
-                    matches = []
-                    for ckvert in dupverts[v_indx]:
-                        if uvlist[ckvert] == uv:
-                            matches += [ckvert]
-                    if len(matches) == 0:
-                    #must be a new UV!
-                        #duplicate existing vertex
-                        vlist[new_index] = vlist[rootindx]
-                        #add its new uv
-                        uvlist[new_index] = uv
-                        #add this index to a list so we can find it later
-                        dupverts[rootindx] += [new_index]
-                        v_indx = new_index
-                        new_index += 1
-                    else:
-                        v_indx = min(matches)
-                else:
-                    uvlist[v_indx] = uv
-                    dupverts[v_indx] += [v_indx]
-                
-            index_list += [v_indx]
-            
-    #re-key to remove gaps from any dropped/invalid verts
-    indexlookup = {}
-    newindex = 0
-    tempindexlist=[]
-    vkeys = vlist.keys()
-    vkeys.sort()
-    for k in vkeys:
-        indexlookup[k]=newindex
-        newindex += 1
-        
-    #reindex index_list
-    for i in index_list:
-        tempindexlist.append(indexlookup[i])
-    index_list = tempindexlist[:]
+    # world coordinates and normals of the valid verts, quantized
+    xs, ys, zs = world_positions(ob)
+    normals = [mobj.verts[i].no for i in goodindx]
+    vlist = zip(xr.adjust_all([xs[i] for i in goodindx]),
+        yr.adjust_all([ys[i] for i in goodindx]),
+        zr.adjust_all([zs[i] for i in goodindx]),
+        nr.adjust_all([no[0] for no in normals]),
+        nr.adjust_all([no[1] for no in normals]),
+        nr.adjust_all([no[2] for no in normals]))
+    
+    # quantized uv (and lightmap uv) of every face corner
+    if (has_lightmap):
+        uvs = zip(txr.adjust_all(us), tyr.adjust_all(vs),
+            lmxr.adjust_all(lmus), lmyr.adjust_all(lmvs))
+    else:
+        uvs = zip(txr.adjust_all(us), tyr.adjust_all(vs))
+    corners = zip(corners, uvs)
+    index_list, vrows, uvlist, dupverts = split_vertices(goodindx, corners)
     
-    # ********** write face count **************  
+    print 'mesh %s: %d verts split to %d (%.2fx) : %.4f sec.' % (ob.name,
+        len(goodindx), len(vrows), len(vrows) / float(max(len(goodindx), 1)),
+        Blender.sys.time()-split_time)
+    
+    # Start Writin' !!
+    # *** write material index, face & vertex counts and mesh flags ***
     faces = len(index_list)/3
-    stream.write(struct.pack("L", faces))
-    # ********** write vertex count ************
-    stream.write(struct.pack("L", len(vlist)))
-    # ************ write mesh flags ************
-    stream.write(struct.pack("BBBB", meshflags1, meshflags2, bone_per_vertex, unkflag))
+    stream.write(msh_records.mesh_header.pack(materialid = materialid,
+        face_count = faces, vertex_count = len(vrows),
+        flags1 = meshflags1, flags2 = meshflags2,
+        bone_per_vertex = bone_per_vertex, unk_flag = unkflag))
     if has_meshid:
-        stream.write(struct.pack("LlL", indexid, vertexid, skeletonid))
-
-    # ************** write ranges *************
-    stream.write(struct.pack("f", xr.min))
-    stream.write(struct.pack("f", yr.min))
-    stream.write(struct.pack("f", zr.min))
-    stream.write(struct.pack("f", xr.max))
-    stream.write(struct.pack("f", yr.max))
-    stream.write(struct.pack("f", zr.max))
-    stream.write(struct.pack("f", txr.min))
-    stream.write(struct.pack("f", 1 - tyr.min))
-    stream.write(struct.pack("f", txr.max))
-    stream.write(struct.pack("f", 1 - tyr.max))
-    # ************ write lmap range *************
-    stream.write(struct.pack("f", lmxr.min))
-    stream.write(struct.pack("f", 1 - lmyr.min))
-    stream.write(struct.pack("f", lmxr.max))
-    stream.write(struct.pack("f", 1 - lmyr.max))
+        stream.write(msh_records.mesh_ids.pack(indexid = indexid,
+            vertexid = vertexid, skeletonid = skeletonid))
+
+    # ********* write ranges and lmap range *********
+    stream.write(msh_records.mesh_ranges.pack(
+        min_x = xr.min, min_y = yr.min, min_z = zr.min,
+        max_x = xr.max, max_y = yr.max, max_z = zr.max,
+        min_tx = txr.min, min_ty = 1 - tyr.min,
+        max_tx = txr.max, max_ty = 1 - tyr.max,
+        min_lm_x = lmxr.min, min_lm_y = 1 - lmyr.min,
+        max_lm_x = lmxr.max, max_lm_y = 1 - lmyr.max))
     # *********** write neckdata count **********
     if has_neckconnect:
-        ncpos = stream.tell()
-        stream.write(struct.pack("L",neckconnect_count))
+        ncpos = stream.reserve(struct.pack("<L",neckconnect_count))
 
     # ****** write face list*******
-    for tri in index_list:
-        stream.write(struct.pack("H", tri))
+    stream.write(array("H", index_list).tostring())
 
     if faces & 1:
         stream.write("\x00\x00")
         
     # ********** write vertices **************
-    vkeys = vlist.keys()
-    vkeys.sort()
-    for k in vkeys:
-        v = vlist[k]
-        stream.write(struct.pack("HHHHHH", v[0], v[1], v[2], v[3], v[4], v[5]))
-        #write uv
-        stream.write(struct.pack("HH", uvlist[k][0], uvlist[k][1]))
+    # position, normal and uv, see msh_records.compressed_vertex
+    vertices = array("H")
+    for k, row in enumerate(vrows):
+        vertices.extend(vlist[row])
+        vertices.extend(uvlist[k][0:2])
+    stream.write(vertices.tostring())
 
     # Lightmap UVs
     if has_lightmap:
-        for k in vkeys:
-            stream.write(struct.pack("HH", lmuvlist[k][0], lmuvlist[k][1]))
+        lightmap = array("H")
+        for uv in uvlist:
+            lightmap.extend(uv[2:4])
+        stream.write(lightmap.tostring())
             
     if is_boned:
         mobj.activeUVLayer = 'UVTex'
-        # build vert weight list
-        weights = {}
-        for i,dup in dupverts.items():
-            for dv in dup:
-                weights[dv] = mobj.getVertexInfluences(i)
+        # the 4 strongest influences of every valid vert (ties go to the
+        # higher bone index), packed once and shared by its split copies.
+        # Missing influences get weight 0 and the last bone given.
+        records = []
+        last_bones = []
+        for i in goodindx:
+            bw_pair = [(-float(w), -bone_index[name], w)
+                for name, w in mobj.getVertexInfluences(i)
+                if name != 'neckconnect']
+            bw_pair.sort()
+            bw_pair = bw_pair[:4]
+            if bw_pair:
+                bw_values = [bw[2] for bw in bw_pair] + [0] * (4 - len(bw_pair))
+                bones = [-bw[1] for bw in bw_pair]
+                bones += [bones[-1]] * (4 - len(bones))
+                records.append(msh_records.bone_weights.pack_values(
+                    *(bw_values + bones)))
+                last_bones.append(bones[-1])
+            else:
+                records.append(None)
+                last_bones.append(None)
                 
         # ********** write bone weights **************
         # w0,w1,w2,w3, b0,b1,b2,b3
-        for k in vkeys:
-            # fetch the bone/weight pair
-            vinf = weights[k]
-            bw_pair = filter(lambda x: x[0] !='neckconnect', vinf)
-            bw_pair.sort(key=lambda x:-x[1])
-            bonesort = []
-            for bw in bw_pair:
-                boneref = bone_lookup.index(bw[0])
-                bonesort.append([bw[1], boneref, bw[0]])
-            bonesort.sort(lambda x,y: cmp(float(y[0]),float(x[0])) or cmp(y[1],x[1]))
-
-            for bw_cnt in range(4):
-                if len(bw_pair) > bw_cnt:
-                    stream.write(struct.pack("f", bonesort[bw_cnt][0]))
-                else:
-                    stream.write(struct.pack("f", 0))
-                    
-            for bw_cnt in range(4):
-                if len(bw_pair) > bw_cnt:
-                    last_bone = bonesort[bw_cnt][1]
-                stream.write(struct.pack("b", last_bone))  
+        # verts without influences carry on the last bone written
+        block = []
+        last_bone = None
+        for row in vrows:
+            record = records[row]
+            if record is None:
+                record = msh_records.bone_weights.pack_values(0, 0, 0, 0,
+                    last_bone, last_bone, last_bone, last_bone)
+            else:
+                last_bone = last_bones[row]
+            block.append(record)
+        stream.write("".join(block))
                 
     # write Neck Data
     if has_neckconnect:
@@ -711,19 +676,23 @@ def write_mesh(ob, stream):
             else:
                 print "WARNING: mshType is not set to either \'FemaleCostume\' or \'MaleCostume\' -- defaulting to Male neckpoints."
                 neckpts = tmConst.NECK_MALE
+            # neck points are numbered as before the gaps of loose verts
+            # are closed: the split copies count on from the last used
+            # vert
+            copy_base = goodindx[-1] + 1 - len(goodindx)
             npts = {}
             for n in mobj.getVertsFromGroup('neckconnect'):
-                root = dupverts[n][0]
-                for pt in dupverts[n]:
-                    npts[pt] = getNeckIndex(mobj.verts[root].co, neckpts)
+                co = getNeckIndex(mobj.verts[n].co, neckpts)
+                for k in dupverts[n]:
+                    if k < len(goodindx):
+                        npts[goodindx[k]] = co
+                    else:
+                        npts[k + copy_base] = co
             #backpatch neckpoints count
-            cpos = stream.tell()
-            stream.seek(ncpos)
-            stream.write(struct.pack("L",len(npts)))
-            stream.seek(cpos)
+            stream.patch(ncpos, struct.pack("<L",len(npts)))
             #write it!
-            for pt,co in npts.items():
-                stream.write(struct.pack("LL", pt, co))
+            stream.write("".join([struct.pack("<LL", pt, co)
+                for pt,co in npts.items()]))
 
 def write_armature(stream):
     if has_bones:
@@ -732,28 +701,26 @@ def write_armature(stream):
         if (len(bone_list)):
             #write_null("L", stream)
             #Skeleton ID
-            stream.write(struct.pack("L", rigID))
-            stream.write(struct.pack("L", len(bone_list)))
+            stream.write(struct.pack("<L", rigID))
+            stream.write(struct.pack("<L", len(bone_list)))
               
             #bp_lookup = []
             for bone in bone_list:
                 #bp_lookup.append(bone.name)
                 boneparent = -1
                 if bone.parent:
-                    boneparent = bone_lookup.index(bone.parent.name)
+                    boneparent = bone_index[bone.parent.name]
                 write_bone(stream, bone, boneparent)
 
 
 def write_bone(stream, bone, boneparent):
     write_nts(bone.name, stream)
-    stream.write(struct.pack("l", boneparent))
 
     bone_matrix = bone.matrix["ARMATURESPACE"]
+    # bones are stored with their roll axis first
+    rows = (bone_matrix[1], bone_matrix[2], bone_matrix[0], bone_matrix[3])
 
-    stream.write(struct.pack("fff", bone_matrix[1][0], bone_matrix[1][1], bone_matrix[1][2]))
-    stream.write(struct.pack("fff", bone_matrix[2][0], bone_matrix[2][1], bone_matrix[2][2]))
-    stream.write(struct.pack("fff", bone_matrix[0][0], bone_matrix[0][1], bone_matrix[0][2]))
-    stream.write(struct.pack("fff", bone_matrix[3][0], bone_matrix[3][1], bone_matrix[3][2]))
+    stream.write(msh_records.bone.pack(parent = boneparent, **matrix_fields(rows)))
             
             
 def write_anchor(anchor, stream):
@@ -765,18 +732,10 @@ def write_anchor(anchor, stream):
     write_nts(ancname, stream)
     anc_matrix = anchor.matrixWorld
     
-    stream.write(struct.pack("fff", anc_matrix[0][0], anc_matrix[0][1], anc_matrix[0][2]))
-    stream.write(struct.pack("fff", anc_matrix[1][0], anc_matrix[1][1], anc_matrix[1][2]))
-    stream.write(struct.pack("fff", anc_matrix[2][0], anc_matrix[2][1], anc_matrix[2][2]))
-    stream.write(struct.pack("fff", anc_matrix[3][0], anc_matrix[3][1], anc_matrix[3][2]))
+    stream.write(msh_records.anchor.pack(**matrix_fields(anc_matrix)))
     
 def write_shape(shape, stream):
-    stream.write(struct.pack("L",0))
     sh_matrix = shape.matrixWorld
-    stream.write(struct.pack("fff", sh_matrix[0][0], sh_matrix[0][1], sh_matrix[0][2]))
-    stream.write(struct.pack("fff", sh_matrix[1][0], sh_matrix[1][1], sh_matrix[1][2]))
-    stream.write(struct.pack("fff", sh_matrix[2][0], sh_matrix[2][1], sh_matrix[2][2]))
-    stream.write(struct.pack("fff", sh_matrix[3][0], sh_matrix[3][1], sh_matrix[3][2]))
     
     bb = calc_bbox(shape.getBoundBox(1))
     
@@ -784,7 +743,9 @@ def write_shape(shape, stream):
     Sizey = (0 - bb[2]) + bb[3]
     Sizez = (0 - bb[4]) + bb[5]
     
-    stream.write(struct.pack("fff", Sizex, Sizey, Sizez))
+    stream.write(msh_records.shape.pack(unknown = 0,
+        size_x = Sizex, size_y = Sizey, size_z = Sizez,
+        **matrix_fields(sh_matrix)))
     
 #***********************************************
 # main export function
@@ -795,6 +756,7 @@ def save_msh(filename):
     '''
     
     global material_list, material_keys, Bounds, mshType, bone_list, bone_lookup, rigID, has_bones
+    global world_verts, bone_index
     global clickable, min_outline, z_height, lot_boundary, neg_space, shadow, collision
    
     time1 = Blender.sys.time()  #for timing purposes
@@ -803,6 +765,7 @@ def save_msh(filename):
     #Get Scene ID Properties
     scn = Blender.Scene.GetCurrent()
     Bounds = [0,0,0,0,0,0] 
+    world_verts = {}
     mshflags1 = 0
     mshflags2 = 0 
     has_named_groups = 0
@@ -845,6 +808,7 @@ def save_msh(filename):
     room_list = {}
     bone_list = []
     bone_lookup = []
+    bone_index = {}
     
     # Groups
     rigID = 0
@@ -999,6 +963,7 @@ def save_msh(filename):
         
     else:
         has_bones = 0
+    bone_index = bone_palette(bone_lookup)
         
     mshflags2 |= (has_shapes * 2)
     mshflags2 |= (has_childmesh * 64)
@@ -1009,93 +974,90 @@ def save_msh(filename):
     # write header
     #*******************************************
     stream = open(filename, 'wb')
-    stream.write(struct.pack("L",10))
-    
-    # image count 
-    stream.write(struct.pack("L", len(image_list)))
-    # material count 
-    stream.write(struct.pack("L", len(material_keys)))
-    # group count 
-    stream.write(struct.pack("L",len(group_values)))
-    # has bones
-    stream.write(struct.pack("B", has_bones))
-    # static anims
-    stream.write(struct.pack("B", has_static_anim))
-    # anchor count
-    stream.write(struct.pack("B", len(anchor_list)))
-    # clickable mesh
-    if clickable is not None:
-        stream.write("\x01")
-    else:
-        stream.write("\x00")
-    #  has outline
-    stream.write("\x00")
-    # flags 1
-    stream.write(struct.pack("B", mshflags1))
-    # flags 2
-    stream.write(struct.pack("B", mshflags2))
-    # named groups
-    stream.write(struct.pack("B", has_named_groups))
+    # each section is put together in memory and written in one go
+    out = section_writer()
+    # version, image/material/group counts, bones, static anims,
+    # anchor count, clickable mesh, flags 1 & 2 and named groups
+    out.write(msh_records.msh_header.pack(version = 10,
+        image_count = len(image_list),
+        material_count = len(material_keys),
+        group_count = len(group_values),
+        has_bones = has_bones,
+        has_static_anim = has_static_anim,
+        anchor_count = len(anchor_list),
+        has_clickable = int(clickable is not None),
+        flags1 = mshflags1,
+        flags2 = mshflags2,
+        has_named_groups = has_named_groups))
     # shape count
     if has_shapes:
-        stream.write(struct.pack("L", len(shape_list)))
+        out.write(struct.pack("<L", len(shape_list)))
     # childmesh (?)
     if has_childmesh:
-        stream.write(struct.pack("L", len(childmesh_list))) 
+        out.write(struct.pack("<L", len(childmesh_list))) 
     # room count
     if has_rooms:
-        stream.write(struct.pack("L", len(room_list)))
+        out.write(struct.pack("<L", len(room_list)))
     # end header **************************
+    out.flush(stream)
     print 'header written : %.4f sec.' % (Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
     
     # image list
     for i in image_list:
         im = os.path.split(i)[1]
-        write_nts(im, stream)
+        write_nts(im, out)
+    out.flush(stream)
     print '%d images written : %.4f sec.' % (len(image_list), Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
     
         
     # material list
     for mat in material_list:
-        write_material(mat, stream)
+        write_material(mat, out)
+    out.flush(stream)
     print '%d materials written : %.4f sec.' % (len(material_list), Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
 
     # control meshes
-    write_control_meshes(stream)
+    write_control_meshes(out)
+    out.flush(stream)
     print 'control_meshes written : %.4f sec.' % (Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
 
     # rooms
     for n in room_list:
-        write_nts(n, stream)
-        write_basic_mesh(room_list[n], stream)
+        write_nts(n, out)
+        write_basic_mesh(room_list[n], out)
+    out.flush(stream)
     print '%d rooms written : %.4f sec.' % (len(room_list), Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
 
     # groups - mesh contents
     for g in group_values:
-        write_group(g, stream)
+        write_group(g, out)
+        out.flush(stream)
         print 'group written : %.4f sec.' % (Blender.sys.time()-prev_time)
         prev_time = Blender.sys.time()
         
 
     # bones goes here
-    write_armature(stream)
+    write_armature(out)
+    out.flush(stream)
     print 'armatures written : %.4f sec.' % (Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
 
     # group names
     for g in group_names:
-        write_nts(g, stream)
+        write_nts(g, out)
+    out.flush(stream)
     print '%d group_names written : %.4f sec.' % (len(group_names), Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
     
     # Anchors
     for a in anchor_list:
-        write_anchor(a, stream)
+        write_anchor(a, out)
+    out.flush(stream)
     print '%d anchors written : %.4f sec.' % (len(anchor_list), Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
     
@@ -1104,7 +1066,8 @@ def save_msh(filename):
     # Shapes
     # not sure what they're for, but we can write them!
     for s in shape_list:
-        write_shape(s, stream)
+        write_shape(s, out)
+    out.flush(stream)
     print '%d shapes written : %.4f sec.' % (len(shape_list), Blender.sys.time()-prev_time)
     prev_time = Blender.sys.time()
         
@@ -0,0 +1,64 @@
+#!BPY
+
+"""
+Name: 'The Movies (.msh) preview...'
+Blender: 246
+Group: 'Import'
+Tooltip: 'Quick low detail import of a msh file from Lionhead Studios The Movies. (.msh)'
+"""
+
+__author__ = ["Glen Rickey, Nick Hudson, Mark S Andrews"]
+__url__ = ("Director's Cut Modding Foundry","http://www.dcmodding.com")
+__version__ = "1.00 04-05-2009"
+__bpydoc__ = """\
+
+Msh Preview Importer
+
+Imports a msh file for a quick look at its layout, for example to find
+a prop location in a big set.  Each mesh is reduced to at most
+msh_import.PREVIEW_FACES faces (or to its bounding box, if that can't
+be done), and textures, materials, lightmaps, bone weights and the
+armature are left out.  Control meshes, rooms, anchors and shapes are
+imported as usual.
+
+The objects are tagged with the file they came from.  Importing the
+same file again with the normal msh importer replaces them.
+
+"""
+
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# Script copyright (C) Mark S Andrews, Nick Hudson, Glen Rickey
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+# --------------------------------------------------------------------------
+
+
+# Import modules
+
+import Blender
+import msh_import
+
+
+#***********************************************
+# register callback
+#***********************************************
+def my_callback(filename):
+    msh_import.load_msh(filename, preview=msh_import.PREVIEW_FACES)
+
+if __name__ == '__main__':
+    Blender.Window.FileSelector(my_callback, "Preview MSH", '*.msh')
@@ -0,0 +1,875 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# Script copyright (C) Mark S Andrews, Nick Hudson, Glen Rickey
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+# --------------------------------------------------------------------------
+
+__author__ = ["Glen Rickey, Nick Hudson, Mark S Andrews"]
+__url__ = ("Director's Cut Modding Foundry","http://www.dcmodding.com")
+__version__ = "1.00 04-05-2009"
+__bpydoc__ = """\
+
+Msh Reader
+
+Decodes a msh file from Lionhead Studio Limited's The Movies into a plain
+in-memory model (header, images, materials, control meshes, rooms, groups,
+meshes, skeleton, group names, anchors and shapes).
+
+Nothing in here touches Blender, so it can be used from a plain Python
+interpreter to parse files in batch or to profile decoding on its own.
+msh_import.py turns the model into Blender objects.
+
+scan_msh() indexes the byte offset of every section without decoding
+them, so an msh_selection of groups, control meshes, rooms and the
+skeleton can be loaded on its own.
+
+"""
+
+
+# Import modules
+
+import struct, mmap
+from array import array
+from itertools import izip, groupby
+from operator import itemgetter
+import msh_records
+from msh_records import material, compressed_vertex, bone_weights, \
+    skeleton_header, shape
+
+
+#***********************************************
+# helper classes & functions for msh file
+#***********************************************
+
+class msh_cursor(object):
+    '''Decodes a msh file held in one buffer (a string or an mmap).
+
+    offset is the position of the next item.  Nothing is copied out of
+    the buffer until it is decoded; view() hands out blocks as buffer
+    objects that share the underlying memory, for decoding straight
+    from the file without keeping them.
+    '''
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def unpack(self, layout):
+        # layout is a precompiled struct.Struct
+        try:
+            value = layout.unpack_from(self.data, self.offset)
+        except struct.error:
+            raise ValueError("Unexpected end of mesh file")
+        self.offset += layout.size
+        return value
+
+    def view(self, length):
+        block = buffer(self.data, self.offset, length)
+        if len(block) != length:
+            raise ValueError("Unexpected end of mesh file")
+        self.offset += length
+        return block
+
+    def read(self, length):
+        value = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def skip(self, length):
+        self.offset += length
+
+    def seek(self, offset):
+        self.offset = offset
+
+_structs = {}
+
+def get_struct(struct_type):
+    # struct_type is read little endian with standard sizes, see
+    # msh_records
+    try:
+        return _structs[struct_type]
+    except KeyError:
+        layout = _structs[struct_type] = struct.Struct("<" + struct_type)
+        return layout
+
+def read_item(struct_type, cursor):
+    value = cursor.unpack(get_struct(struct_type))
+    if len(value) == 1:
+        value = value[0]
+    return value
+
+def read_nts(cursor, length=32):
+    s = cursor.read(length)
+    return s.rstrip("\x00")
+
+# uint32 blocks are read as "I" arrays, "L" items are 8 bytes on 64 bit
+assert array("I").itemsize == 4
+
+def read_array(typecode, count, cursor):
+    # a whole block of one item type
+    values = array(typecode)
+    values.fromstring(cursor.view(values.itemsize * count))
+    return values
+
+def read_table(cls, count, cursor, name_attr=None):
+    # count records of cls in one go, see msh_records.unpack_table;
+    # name_attr is set to the 32 byte name in front of each record
+    name_length = 0
+    if name_attr:
+        name_length = 32
+    try:
+        names, records, size = msh_records.unpack_table(cls, cursor.data,
+            cursor.offset, count, name_length)
+    except struct.error:
+        raise ValueError("Unexpected end of mesh file")
+    cursor.skip(size)
+    if name_attr:
+        for r, name in zip(records, names):
+            setattr(r, name_attr, name)
+    return records
+
+def dequantize(values, stride, columns):
+    '''Scales packed 16 bit columns back to floats.
+
+    values holds stride items per vertex; columns pairs each wanted
+    column offset with the range_adjust for it.  Returns the adjusted
+    columns interleaved as a float32 array.
+    '''
+    count = len(values) / stride
+    width = len(columns)
+    result = array("f", [0.0]) * (count * width)
+    for i, (offset, column_range) in enumerate(columns):
+        base = column_range.min
+        step = column_range.step
+        result[i::width] = array("f",
+            [base + v * step for v in values[offset::stride]])
+    return result
+
+def group_weights(bone_ids, weights):
+    '''Groups the vertices of a skinned mesh by bone and weight.
+
+    bone_ids and weights hold four influences per vertex.  Returns
+    {bone: {weight: [vertex ids]}}, ready for assignVertsToGroup.
+    Unused influences (bone -1) are left out.
+    '''
+    influences = sorted([(b, w, i >> 2) for i, (b, w)
+        in enumerate(izip(bone_ids, weights)) if b != -1])
+    groups = {}
+    for (b, w), items in groupby(influences, itemgetter(0, 1)):
+        groups.setdefault(b, {})[w] = [item[2] for item in items]
+    return groups
+
+def weld_vertices(positions, normals=None):
+    '''Welds the vertices the exporter split along uv and lightmap seams.
+
+    Vertices at the same position (and with the same normal, if normals
+    is given) become one.  Returns (remap, kept): remap[i] is the welded
+    index of vertex i, kept[j] the first vertex welded into vertex j.
+    '''
+    keys = izip(positions[0::3], positions[1::3], positions[2::3])
+    if normals is not None:
+        keys = izip(keys, izip(normals[0::3], normals[1::3], normals[2::3]))
+    seen = {}
+    remap = array("i", [seen.setdefault(key, len(seen)) for key in keys])
+    kept = array("i", [0]) * len(seen)
+    for i in xrange(len(remap) - 1, -1, -1):
+        kept[remap[i]] = i
+    return remap, kept
+
+def take_rows(values, width, rows):
+    '''The rows (of width items each) of values, in the order given.'''
+    result = array(values.typecode)
+    for i in rows:
+        result.extend(values[width * i:width * i + width])
+    return result
+
+def bounding_box(positions):
+    '''(positions, faces) of the box around positions, 12 triangles.'''
+    columns = [positions[k::3] for k in range(3)]
+    lo = [min(c) for c in columns]
+    hi = [max(c) for c in columns]
+    box = array("f")
+    for i in range(8):
+        for k in range(3):
+            box.append((lo[k], hi[k])[(i >> k) & 1])
+    faces = array("i", [0,2,1, 1,2,3, 4,5,6, 5,7,6, 0,1,4, 1,5,4,
+        2,6,3, 3,6,7, 0,4,2, 2,4,6, 1,3,5, 3,7,5])
+    return box, faces
+
+def cluster_vertices(positions, faces, cells):
+    '''Vertex clustering: one vertex (the mean) per occupied cell of a grid
+    of cells x cells x cells over the bounding box.  Faces that collapse
+    or repeat are dropped.  Returns (positions, faces).
+    '''
+    columns = [positions[k::3] for k in range(3)]
+    lo = [min(c) for c in columns]
+    scale = [cells / ((max(c) - l) or 1.0) for c, l in zip(columns, lo)]
+    last = cells - 1
+    keys = izip(*[[min(int((v - l) * f), last) for v in c]
+        for c, l, f in zip(columns, lo, scale)])
+    seen = {}
+    remap = [seen.setdefault(key, len(seen)) for key in keys]
+
+    sums = [[0.0, 0.0, 0.0, 0] for i in xrange(len(seen))]
+    for i, j in enumerate(remap):
+        total = sums[j]
+        total[0] += positions[3*i]
+        total[1] += positions[3*i+1]
+        total[2] += positions[3*i+2]
+        total[3] += 1
+    clustered = array("f")
+    for x, y, z, n in sums:
+        clustered.extend((x / n, y / n, z / n))
+
+    kept = array("i")
+    done = set()
+    for k in xrange(0, len(faces) - 2, 3):
+        face = (remap[faces[k]], remap[faces[k+1]], remap[faces[k+2]])
+        key = tuple(sorted(face))
+        if key[0] != key[1] and key[1] != key[2] and key not in done:
+            done.add(key)
+            kept.extend(face)
+    return clustered, kept
+
+def decimate(positions, faces, budget):
+    '''(positions, faces) of a stand-in for a mesh with at most budget
+    faces, by vertex clustering on ever coarser grids.  Falls back to the
+    bounding box (12 faces), which a budget of 0 always gives.  Meshes
+    that already fit the budget, or are no bigger than the box, are
+    returned as they are.
+    '''
+    if not positions:
+        return positions, faces
+    if len(faces) / 3 <= max(budget, 12):
+        return positions, faces
+    cells = 64
+    while budget and cells > 1:
+        clustered, kept = cluster_vertices(positions, faces, cells)
+        if not kept:
+            # everything fell into one cell, coarser grids won't help
+            break
+        if len(kept) / 3 <= budget:
+            return clustered, kept
+        cells /= 2
+    return bounding_box(positions)
+
+class range_adjust(object):
+    def __init__(self, min, max):
+        self.min = min
+        self.max = max
+        self.step = (max - min) / 65535.0
+        object.__init__(self)
+    def adjust(self, value):
+        return self.min + (value * self.step)
+
+#***********************************************
+# class definitions for msh file
+#***********************************************
+
+# material, skeleton_header and shape are read exactly as declared in
+# msh_records; compressed_vertex and bone_weights blocks are read as arrays.
+
+class msh_header(msh_records.msh_header):
+    __slots__ = ("shape_count", "childmesh_count", "room_count")
+
+    def __init__(self, cursor):
+        msh_records.msh_header.__init__(self, cursor)
+        if self.version != 10:
+            raise ValueError("Not a valid mesh file")
+
+        if self.has_shapes:
+            self.shape_count = read_item("L", cursor)
+        else:
+            self.shape_count = 0
+
+        if self.has_childmesh:
+            self.childmesh_count = read_item("L", cursor)
+        else:
+            self.childmesh_count = 0
+
+        if self.has_rooms:
+            self.room_count = read_item("L", cursor)
+        else:
+            self.room_count = 0
+
+class mesh_header(msh_records.mesh_header):
+    __slots__ = ("indexid", "vertexid", "skeletonid", "neckconnect_count",
+        "x_range", "y_range", "z_range", "n_range",
+        "tx_range", "ty_range", "lm_x_range", "lm_y_range")
+
+    def __init__(self, cursor):
+        msh_records.mesh_header.__init__(self, cursor)
+        if self.has_meshid:
+            ids = msh_records.mesh_ids(cursor)
+            self.indexid = ids.indexid
+            self.vertexid = ids.vertexid
+            self.skeletonid = ids.skeletonid
+        else:
+            self.indexid = None
+            self.vertexid = None
+            self.skeletonid = None
+
+        if self.is_compressed:
+            r = msh_records.mesh_ranges(cursor)
+            self.x_range = range_adjust(r.min_x, r.max_x)
+            self.y_range = range_adjust(r.min_y, r.max_y)
+            self.z_range = range_adjust(r.min_z, r.max_z)
+            self.tx_range = range_adjust(r.min_tx, r.max_tx)
+            self.ty_range = range_adjust(1.0 - r.min_ty, 1.0 - r.max_ty)
+            self.lm_x_range = range_adjust(r.min_lm_x, r.max_lm_x)
+            self.lm_y_range = range_adjust(1.0 - r.min_lm_y, 1.0 - r.max_lm_y)
+            self.n_range = range_adjust(-1.0, 1.0)
+
+        if self.has_neckconnect:
+            self.neckconnect_count = read_item("L", cursor)
+        else:
+            self.neckconnect_count = 0
+
+class group_header(msh_records.group_header):
+    __slots__ = ("hidden_on", "hidden_off")
+
+    def __init__(self, cursor):
+        msh_records.group_header.__init__(self, cursor)
+        if self.has_hidden:
+            self.hidden_on = read_item("H", cursor)
+            self.hidden_off = read_item("H", cursor)
+        else:
+            self.hidden_on = 0
+            self.hidden_off = 0
+
+class anchor(msh_records.anchor):
+    __slots__ = ("anchor_name",)
+
+    def __init__(self, cursor):
+        self.anchor_name = read_nts(cursor)
+        msh_records.anchor.__init__(self, cursor)
+
+class bone(msh_records.bone):
+    __slots__ = ("bone_name",)
+
+    def __init__(self, cursor):
+        self.bone_name = read_nts(cursor)
+        msh_records.bone.__init__(self, cursor)
+
+#***********************************************
+# decoded model of a msh file
+#***********************************************
+
+class control_mesh(object):
+    '''Vertex positions and triangles of a control mesh or room.
+
+    vertices is a flat float32 array, three per vertex, and faces a flat
+    uint16 array of vertex indices, three per face.
+    '''
+    def __init__(self, name, vertices, faces):
+        self.name = name
+        self.vertices = vertices
+        self.faces = faces
+
+class msh_mesh(object):
+    '''One textured mesh of a group.
+
+    faces is a flat uint16 array of vertex indices, three per face.
+    positions and normals hold three floats per vertex, uvs and
+    lightmap_uvs two (lightmap_uvs is empty without a lightmap).
+    bone_ids (int8) and weights (float) hold four influences per vertex
+    and are empty for meshes without weights.
+
+    remap and kept weld the seam copies of vertices back together, see
+    weld_vertices.
+    '''
+    def __init__(self, header, faces, positions, normals, uvs, lightmap_uvs,
+            bone_ids, weights, neckdata, remap, kept):
+        self.header = header
+        self.faces = faces
+        self.positions = positions
+        self.normals = normals
+        self.uvs = uvs
+        self.lightmap_uvs = lightmap_uvs
+        self.bone_ids = bone_ids
+        self.weights = weights
+        self.neckdata = neckdata
+        self.remap = remap
+        self.kept = kept
+
+class msh_group(object):
+    def __init__(self, header, meshes):
+        self.header = header
+        self.meshes = meshes
+
+class msh_skeleton(object):
+    '''matrices holds the bone matrices, see msh_records.matrix_stack.'''
+    def __init__(self, header, bones):
+        self.header = header
+        self.bones = bones
+        self.matrices = msh_records.matrix_stack(bones)
+
+class msh_model(object):
+    '''Everything read from a msh file, in file order.
+
+    anchor_matrices and shape_matrices stack the matrices of the anchors
+    and shapes, see msh_records.matrix_stack.
+    '''
+    def __init__(self, filename=None, data=None):
+        self.filename = filename
+        self.data = data
+        self.header = None
+        self.images = []
+        self.materials = []
+        self.control_meshes = []
+        self.rooms = []
+        self.groups = []
+        self.skeleton = None
+        self.group_names = []
+        self.anchors = []
+        self.anchor_matrices = array("f")
+        self.convex_hull_size = 0
+        self.shapes = []
+        self.shape_matrices = array("f")
+
+    def close(self):
+        '''Releases the file buffer.  The decoded arrays and records
+        stay, and can be pickled.'''
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+
+class msh_index(object):
+    '''Byte offsets of the sections of a msh file, see scan_msh().
+
+    control_meshes and rooms pair each name with the offset of its data,
+    meshes holds the mesh offsets of each group.  Sections the file
+    doesn't have are None (or empty).  group_names are decoded, since
+    selections can name groups.
+    '''
+    def __init__(self, header):
+        self.header = header
+        self.images = None
+        self.materials = None
+        self.control_meshes = []
+        self.rooms = []
+        self.groups = []
+        self.meshes = []
+        self.skeleton = None
+        self.group_names = []
+        self.anchors = None
+        self.convex_hull = None
+        self.shapes = None
+        self.end = None
+
+class msh_selection(object):
+    '''The parts of a msh file to load.
+
+    groups is a sequence of group indices and/or group names,
+    control_meshes a sequence of CONTROL_MESHES names and rooms a sequence
+    of room names; None selects all of them.  skeleton, anchors and shapes
+    switch those sections on or off.  Images and materials are always
+    loaded, the meshes refer to them by index.
+    '''
+    def __init__(self, groups=None, control_meshes=None, rooms=None,
+            skeleton=True, anchors=True, shapes=True):
+        self.groups = groups
+        self.control_meshes = control_meshes
+        self.rooms = rooms
+        self.skeleton = skeleton
+        self.anchors = anchors
+        self.shapes = shapes
+
+    def has_group(self, groupid, group_name):
+        return (self.groups is None or groupid in self.groups
+            or group_name in self.groups)
+
+    def has_control_mesh(self, name):
+        return self.control_meshes is None or name in self.control_meshes
+
+    def has_room(self, name):
+        return self.rooms is None or name in self.rooms
+
+# control meshes are stored in this order, each behind its header flag
+CONTROL_MESHES = ("clickable",
+                  "collision",
+                  "shadow",
+                  "z_height",
+                  "neg_space",
+                  "min_outline",
+                  "lot_boundary")
+
+#***********************************************
+# reader functions for msh file
+#***********************************************
+
+def read_control_mesh(mesh_name, cursor):
+    vertex_count = read_item("L", cursor)
+    face_count = read_item("L", cursor)
+    vertices = read_array("f", vertex_count * 3, cursor)
+    faces = read_array("H", face_count * 3, cursor)
+    if face_count & 1:
+        cursor.skip(2)
+    return control_mesh(mesh_name, vertices, faces)
+
+def read_mesh(cursor, preview=False):
+    # with preview only the faces and positions are decoded, for a
+    # stand-in mesh; the rest of the mesh is skipped
+    header = mesh_header(cursor)
+
+    faces = read_array("H", header.face_count * 3, cursor)
+    if header.face_count & 1:
+        cursor.skip(2)
+
+    stride = len(compressed_vertex._struct) # one uint16 per field
+    vertices = read_array("H", header.vertex_count * stride, cursor)
+    positions = dequantize(vertices, stride,
+        ((0, header.x_range), (1, header.y_range), (2, header.z_range)))
+    if preview:
+        size = 0
+        if header.has_lightmap:
+            size += 4 * header.vertex_count
+        if header.has_weights:
+            size += bone_weights._layout.size * header.vertex_count
+        size += get_struct("LL").size * header.neckconnect_count
+        cursor.skip(size)
+        return msh_mesh(header, faces, positions, array("f"), array("f"),
+            array("f"), array("b"), array("f"), [], array("i"), array("i"))
+
+    normals = dequantize(vertices, stride,
+        ((3, header.n_range), (4, header.n_range), (5, header.n_range)))
+    uvs = dequantize(vertices, stride,
+        ((6, header.tx_range), (7, header.ty_range)))
+
+    lightmap_uvs = array("f")
+    if header.has_lightmap:
+        lightmap = read_array("H", header.vertex_count * 2, cursor)
+        lightmap_uvs = dequantize(lightmap, 2,
+            ((0, header.lm_x_range), (1, header.lm_y_range)))
+
+    bone_ids = array("b")
+    weights = array("f")
+    if header.has_weights:
+        # 4 float weights then 4 int8 bone ids per vertex, the ids take
+        # up the fifth float column; both are decoded from the one view
+        count = header.vertex_count * 4
+        block = cursor.view(bone_weights._layout.size * header.vertex_count)
+        columns = array("f")
+        columns.fromstring(block)
+        weights = array("f", [0.0]) * count
+        ids = array("b")
+        ids.fromstring(block)
+        bone_ids = array("b", [0]) * count
+        for k in range(4):
+            weights[k::4] = columns[k::5]
+            bone_ids[k::4] = ids[16 + k::20]
+
+    # vertex index and neck point pairs, we only need the vertex index
+    # (neck points are generated new on export)
+    neckconnect = read_array("I", header.neckconnect_count * 2, cursor)
+    neckdata = list(neckconnect[0::2])
+
+    # uv seam copies share their normal, copies along hard edges don't
+    # and stay apart
+    remap, kept = weld_vertices(positions, normals)
+    return msh_mesh(header, faces, positions, normals, uvs, lightmap_uvs,
+        bone_ids, weights, neckdata, remap, kept)
+
+def read_group(cursor, preview=False):
+    header = group_header(cursor)
+    meshes = []
+    for meshid in range(header.mesh_count):
+        meshes.append(read_mesh(cursor, preview))
+    return msh_group(header, meshes)
+
+def read_skeleton(cursor):
+    header = skeleton_header(cursor)
+    bones = read_table(bone, header.bone_count, cursor, "bone_name")
+    return msh_skeleton(header, bones)
+
+#***********************************************
+# section index for msh file
+#***********************************************
+
+# the skip functions step over a section using only its counts
+
+def skip_control_mesh(cursor):
+    vertex_count = read_item("L", cursor)
+    face_count = read_item("L", cursor)
+    cursor.skip(12 * vertex_count + 6 * face_count + (face_count & 1) * 2)
+
+def skip_mesh(cursor):
+    header = msh_records.mesh_header(cursor)
+    if header.has_meshid:
+        cursor.skip(msh_records.mesh_ids._layout.size)
+    if header.is_compressed:
+        cursor.skip(msh_records.mesh_ranges._layout.size)
+    neckconnect_count = 0
+    if header.has_neckconnect:
+        neckconnect_count = read_item("L", cursor)
+
+    vertex_count = header.vertex_count
+    size = 6 * header.face_count + (header.face_count & 1) * 2
+    size += compressed_vertex._layout.size * vertex_count
+    if header.has_lightmap:
+        size += 4 * vertex_count
+    if header.has_weights:
+        size += bone_weights._layout.size * vertex_count
+    size += get_struct("LL").size * neckconnect_count
+    cursor.skip(size)
+
+def scan_msh(data):
+    '''Finds the offset of every section of a msh file held in data.
+
+    Only headers and counts are decoded, the contents of images,
+    materials, meshes and so on are skipped.  Raises ValueError if the
+    data is not a msh file.
+    '''
+    cursor = msh_cursor(data)
+    header = msh_header(cursor)
+    index = msh_index(header)
+
+    index.images = cursor.offset
+    cursor.skip(32 * header.image_count)
+
+    index.materials = cursor.offset
+    cursor.skip(material._layout.size * header.material_count)
+
+    for n in CONTROL_MESHES:
+        if getattr(header, "has_" + n):
+            index.control_meshes.append((n, cursor.offset))
+            skip_control_mesh(cursor)
+
+    for roomid in range(header.room_count):
+        roomname = read_nts(cursor)
+        index.rooms.append((roomname, cursor.offset))
+        skip_control_mesh(cursor)
+
+    for groupid in range(header.group_count):
+        index.groups.append(cursor.offset)
+        group = group_header(cursor)
+        meshes = []
+        for meshid in range(group.mesh_count):
+            meshes.append(cursor.offset)
+            skip_mesh(cursor)
+        index.meshes.append(meshes)
+
+    if header.has_bones:
+        index.skeleton = cursor.offset
+        skeleton = skeleton_header(cursor)
+        cursor.skip((32 + bone._layout.size) * skeleton.bone_count)
+
+    for groupid in range(header.group_count):
+        group_name = "%02d"%groupid
+        if header.has_static_anim or header.has_named_groups:
+            group_name = read_nts(cursor)
+        index.group_names.append(group_name)
+
+    if header.anchor_count:
+        index.anchors = cursor.offset
+        cursor.skip((32 + anchor._layout.size) * header.anchor_count)
+
+    if header.has_convex_hull:
+        index.convex_hull = cursor.offset
+        cursor.skip(read_item("L", cursor) - 4)
+
+    if header.has_shapes:
+        index.shapes = cursor.offset
+        cursor.skip(shape._layout.size * header.shape_count)
+
+    if cursor.offset > len(data):
+        raise ValueError("Unexpected end of mesh file")
+    index.end = cursor.offset
+    return index
+
+#***********************************************
+# reading a msh file
+#***********************************************
+
+def read_msh_selection(data, selection, filename=None, index=None,
+        images_read=None, preview=False):
+    '''Reads the selected sections of a msh file into an msh_model.
+
+    Each section is decoded straight from its offset in the index
+    (scanned from data when not given).  Groups that aren't selected are
+    None in model.groups, so group ids still line up with
+    model.group_names.
+    '''
+    if index is None:
+        index = scan_msh(data)
+    header = index.header
+    cursor = msh_cursor(data, index.images)
+    model = msh_model(filename, data)
+    model.header = header
+    model.group_names = list(index.group_names)
+
+    for imageid in range(header.image_count):
+        model.images.append(read_nts(cursor))
+    if images_read:
+        images_read(model.images)
+
+    model.materials = read_table(material, header.material_count, cursor)
+
+    for n, offset in index.control_meshes:
+        if selection.has_control_mesh(n):
+            cursor.seek(offset)
+            model.control_meshes.append(read_control_mesh(n, cursor))
+
+    for roomname, offset in index.rooms:
+        if selection.has_room(roomname):
+            cursor.seek(offset)
+            model.rooms.append(read_control_mesh(roomname, cursor))
+
+    for groupid, offset in enumerate(index.groups):
+        if selection.has_group(groupid, index.group_names[groupid]):
+            cursor.seek(offset)
+            model.groups.append(read_group(cursor, preview))
+        else:
+            model.groups.append(None)
+
+    if index.skeleton is not None and selection.skeleton:
+        cursor.seek(index.skeleton)
+        model.skeleton = read_skeleton(cursor)
+
+    if index.anchors is not None and selection.anchors:
+        cursor.seek(index.anchors)
+        model.anchors = read_table(anchor, header.anchor_count, cursor,
+            "anchor_name")
+        model.anchor_matrices = msh_records.matrix_stack(model.anchors)
+
+    if index.convex_hull is not None:
+        cursor.seek(index.convex_hull)
+        model.convex_hull_size = read_item("L", cursor)
+
+    if index.shapes is not None and selection.shapes:
+        cursor.seek(index.shapes)
+        model.shapes = read_table(shape, header.shape_count, cursor)
+        model.shape_matrices = msh_records.matrix_stack(model.shapes)
+
+    return model
+
+def read_msh_buffer(data, filename=None, selection=None, images_read=None,
+        preview=False):
+    '''Reads a msh file held in a string or mmap into an msh_model.
+
+    With a selection only the chosen sections are decoded, see
+    read_msh_selection().  images_read is called with the image names as
+    soon as they are decoded, before the rest of the file.  With
+    preview the meshes only get their faces and positions, see
+    read_mesh().
+    '''
+    if selection is not None:
+        return read_msh_selection(data, selection, filename,
+            images_read=images_read, preview=preview)
+
+    cursor = msh_cursor(data)
+    model = msh_model(filename, data)
+    header = msh_header(cursor)
+    model.header = header
+
+    for imageid in range(header.image_count):
+        model.images.append(read_nts(cursor))
+    if images_read:
+        images_read(model.images)
+
+    model.materials = read_table(material, header.material_count, cursor)
+
+    for n in CONTROL_MESHES:
+        if getattr(header, "has_" + n):
+            model.control_meshes.append(read_control_mesh(n, cursor))
+
+    for roomid in range(header.room_count):
+        roomname = read_nts(cursor)
+        model.rooms.append(read_control_mesh(roomname, cursor))
+
+    for groupid in range(header.group_count):
+        model.groups.append(read_group(cursor, preview))
+
+    if header.has_bones:
+        model.skeleton = read_skeleton(cursor)
+
+    for groupid in range(header.group_count):
+        group_name = "%02d"%groupid
+        if header.has_static_anim or header.has_named_groups:
+            group_name = read_nts(cursor)
+        model.group_names.append(group_name)
+
+    model.anchors = read_table(anchor, header.anchor_count, cursor,
+        "anchor_name")
+    model.anchor_matrices = msh_records.matrix_stack(model.anchors)
+
+    #Convex Hull -- size is stored first and includes itself, we skip the rest
+    if header.has_convex_hull:
+        model.convex_hull_size = read_item("L", cursor)
+        cursor.skip(model.convex_hull_size - 4)
+
+    if header.has_shapes:
+        model.shapes = read_table(shape, header.shape_count, cursor)
+        model.shape_matrices = msh_records.matrix_stack(model.shapes)
+
+    return model
+
+def read_msh_stream(stream, filename=None, selection=None, images_read=None,
+        preview=False):
+    return read_msh_buffer(stream.read(), filename, selection, images_read,
+        preview)
+
+def map_file(filename, use_mmap=True):
+    '''The contents of a file, memory mapped where possible.'''
+    stream = open(filename, "rb")
+    try:
+        if use_mmap:
+            try:
+                return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # empty files and some network shares can't be mapped
+                pass
+        return stream.read()
+    finally:
+        stream.close()
+
+def read_msh(filename, use_mmap=True, selection=None, images_read=None,
+        preview=False):
+    '''Reads a msh file into an msh_model, all of it unless a selection
+    (an msh_selection) is given.
+
+    The file is memory mapped (or read in one go) and decoded from that
+    single buffer.  The model keeps the (mapped) file open until
+    model.close() is called.  See read_msh_buffer() for
+    images_read and preview.
+
+    Raises ValueError if the file is not a msh file.
+    '''
+    data = map_file(filename, use_mmap)
+    try:
+        return read_msh_buffer(data, filename, selection, images_read,
+            preview)
+    except:
+        if isinstance(data, mmap.mmap):
+            data.close()
+        raise
+
+def parse_msh(filename, preview=False):
+    '''Reads a msh file into a closed msh_model, for decoding in another
+    process.  If the file can't be read or is not a msh file the error
+    message is returned instead, so one bad file doesn't stop a batch.'''
+    try:
+        model = read_msh(filename, preview=preview)
+    except (IOError, struct.error, ValueError), e:
+        # IOError messages name the file, which the caller knows
+        return getattr(e, "strerror", None) or str(e)
+    model.close()
+    return model
+
+def parse_msh_preview(filename):
+    '''parse_msh() for a preview import.'''
+    return parse_msh(filename, True)
@@ -0,0 +1,463 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# Script copyright (C) Mark S Andrews, Nick Hudson, Glen Rickey
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+# --------------------------------------------------------------------------
+
+__author__ = ["Glen Rickey, Nick Hudson, Mark S Andrews"]
+__url__ = ("Director's Cut Modding Foundry","http://www.dcmodding.com")
+__version__ = "1.00 04-05-2009"
+__bpydoc__ = """\
+
+Msh Records
+
+Fixed size record layouts of the msh file format, shared by msh_reader.py
+and msh_export.py.
+
+Each record class declares its struct layout, its named fields and its
+bit-flags once.  The record_type metaclass compiles that into a
+struct.Struct, __slots__ storage and property accessors, and the same
+declaration packs records back to bytes.
+
+msh files are little endian with 4 byte longs and no padding between
+items, so layouts are compiled with standard sizes ("<") and read the
+same on 32 and 64 bit Pythons.
+
+"""
+
+
+# Import modules
+
+import struct, re
+from array import array
+
+
+#***********************************************
+# record codec
+#***********************************************
+
+_item = re.compile(r"(\d*)([xcbB?hHiIlLqQfdspP])")
+
+def _item_codes(layout):
+    # struct codes of every value in a layout, in order (pad bytes skipped)
+    codes = []
+    for count, code in _item.findall(layout):
+        if code == "x":
+            continue
+        if code in "sp":
+            codes.append(code)
+        else:
+            codes.extend([code] * int(count or 1))
+    return codes
+
+def _wrap(code):
+    # folds an integer into the range of its struct code, so values that
+    # were read signed can be written unsigned and vice versa.  Values
+    # that don't fit the field either way are still an error.
+    bits = struct.calcsize("<" + code) * 8
+    mask = (1 << bits) - 1
+    half = 1 << (bits - 1)
+    def wrap(v):
+        v = int(v)
+        if not -half <= v <= mask:
+            raise struct.error("%d doesn't fit in a %d bit field" % (v, bits))
+        if code.islower():
+            return ((v & mask) ^ half) - half
+        return v & mask
+    return wrap
+
+def _field_getter(index):
+    return property(lambda self: self._value[index])
+
+def _flag_getter(index, bit):
+    return property(lambda self: bool(self._value[index] & bit))
+
+class record_type(type):
+    '''Compiles _struct, _fields and _flags of a record declaration.'''
+    def __new__(meta, name, bases, attrs):
+        attrs.setdefault("__slots__", ())
+        cls = type.__new__(meta, name, bases, attrs)
+        if "_struct" in attrs:
+            cls._layout = struct.Struct("<" + cls._struct)
+            cls._codes = _item_codes(cls._struct)
+            cls._wrappers = [(cls._fields[item], _wrap(cls._codes[cls._fields[item]]))
+                for item in cls._wrapped]
+        for item, index in attrs.get("_fields", {}).items():
+            setattr(cls, item, _field_getter(index))
+        for item, (index, bit) in attrs.get("_flags", {}).items():
+            setattr(cls, item, _flag_getter(index, bit))
+        return cls
+
+class record(object):
+    __metaclass__ = record_type
+    __slots__ = ("_value",)
+    _struct = ""
+    _fields = {}
+    _flags = {}
+    # integer fields written with the other signedness than they are read
+    _wrapped = ()
+
+    def __init__(self, cursor):
+        # cursor is an msh_reader.msh_cursor
+        self._value = cursor.unpack(self._layout)
+
+    @classmethod
+    def unpack_from(cls, data, offset=0):
+        r = cls.__new__(cls)
+        r._value = cls._layout.unpack_from(data, offset)
+        return r
+
+    @classmethod
+    def pack_values(cls, *values):
+        '''Packs every value of the record in order.  The values must
+        already fit their struct codes.'''
+        return cls._layout.pack(*values)
+
+    @classmethod
+    def pack(cls, **items):
+        '''Packs a record from named fields and flags.
+
+        Anything not named is written as zero.  Flags with a bit of 255
+        take up a whole byte and are written as given, others are or-ed
+        into their byte.  Values out of range of their field raise
+        struct.error, except that _wrapped fields may be given signed or
+        unsigned.
+        '''
+        values = [0] * len(cls._codes)
+        for item, value in items.items():
+            if item in cls._fields:
+                values[cls._fields[item]] = value
+        for item, value in items.items():
+            if item in cls._flags:
+                index, bit = cls._flags[item]
+                if bit == 255:
+                    values[index] = value
+                elif value:
+                    values[index] |= bit
+            elif item not in cls._fields:
+                raise TypeError("%s has no field %r" % (cls.__name__, item))
+        for i, wrap in cls._wrappers:
+            values[i] = wrap(values[i])
+        return cls._layout.pack(*values)
+
+    def matrix_rows(self):
+        '''The 3x4 matrix held in the m11..offset_z fields, one list per row.'''
+        v = self._value
+        f = self._fields
+        return [[v[f[name]] for name in MATRIX_FIELDS[row:row + 3]]
+            for row in (0, 3, 6, 9)]
+
+    def __repr__(self):
+        return repr(self._value)
+
+MATRIX_FIELDS = ("m11", "m12", "m13",
+                 "m21", "m22", "m23",
+                 "m31", "m32", "m33",
+                 "offset_x", "offset_y", "offset_z")
+
+def matrix_field_map(first, **fields):
+    '''Field map for a 3x4 matrix starting at value index first.'''
+    for i, name in enumerate(MATRIX_FIELDS):
+        fields[name] = first + i
+    return fields
+
+def matrix_fields(rows):
+    '''Named m11..offset_z values of a 3x4 (or 4x4) matrix, for pack().'''
+    values = {}
+    for i, name in enumerate(MATRIX_FIELDS):
+        values[name] = rows[i / 3][i % 3]
+    return values
+
+#***********************************************
+# record tables
+#***********************************************
+
+def unpack_table(cls, data, offset, count, name_length=0):
+    '''Decodes count records of cls stored back to back in data.
+
+    With name_length each record follows a name of that many bytes.
+    The whole table is unpacked by one struct call.  Returns
+    (names, records, size); names is empty for unnamed tables.
+    '''
+    item = cls._struct
+    if name_length:
+        item = "%ds" % name_length + item
+    # struct keeps its own (bounded) cache of compiled formats
+    values = struct.unpack_from("<" + item * count, data, offset)
+
+    width = len(cls._codes)
+    names = []
+    records = []
+    first = 0
+    if name_length:
+        width += 1
+        names = [name.rstrip("\x00") for name in values[0::width]]
+        first = 1
+    for i in xrange(0, len(values), width):
+        r = cls.__new__(cls)
+        r._value = values[i + first:i + width]
+        records.append(r)
+    return names, records, struct.calcsize("<" + item) * count
+
+def matrix_stack(records):
+    '''The 3x4 matrices of records (all of one type) stacked in one
+    float32 array, 12 values per record in the order of its rows.'''
+    stack = array("f")
+    if not records:
+        return stack
+    cls = type(records[0])
+    order = getattr(cls, "_row_order", (0, 1, 2, 3))
+    fields = [cls._fields[name] for name in MATRIX_FIELDS]
+    values = [r._value for r in records]
+    stack = array("f", [0.0]) * (12 * len(records))
+    for j, row in enumerate(order):
+        for k in range(3):
+            index = fields[row * 3 + k]
+            stack[j * 3 + k::12] = array("f", [v[index] for v in values])
+    return stack
+
+#***********************************************
+# record definitions for msh file
+#***********************************************
+
+class msh_header(record):
+    _struct = "LLLLBBBBxBBB"
+    _fields = {"version":0,
+               "image_count":1,
+               "material_count":2,
+               "group_count":3,
+
+               "anchor_count":6,
+
+               "flags1":8,
+               "flags2":9,
+        }
+    _flags = {"has_bones":(4,255),
+                "has_static_anim":(5,255),
+
+                "has_clickable":(7,255),
+
+                "Unk":(8,1),
+                "has_min_outline":(8,2),
+                "has_z_height":(8,4),
+                "hide_actor_head":(8,8),
+                "hide_actor_hair":(8,16),
+                "is_auto_animated":(8,32),
+                "tex_replace_mode":(8,64),
+                "has_convex_hull":(8,128),
+
+                "has_lot_boundary":(9,1),
+                "has_shapes":(9,2),
+                "has_neg_space":(9,4),
+                "has_shadow":(9,8),
+                "has_collision":(9,16),
+                "has_blueprint":(9,32),
+                "has_childmesh":(9,64),
+                "has_rooms":(9,128),
+
+                "has_named_groups":(10,255),
+        }
+
+class material(record):
+    _struct = "bbbbBBBBBBBBBbBxBBBBbbbx"
+    _fields = {"map0":0,
+        "map1":1,
+        "map2":2,
+        "map3":3,
+        "flags0":4,
+        "alphaenvmap":13,
+        "flags1":14,
+        "color_B":15,
+        "color_G":16,
+        "color_R":17,
+        "color_A":18,
+        "scroll_U":19,
+        "scroll_V":20,
+        "rot_UV":21,
+        }
+    _wrapped = ("alphaenvmap", "scroll_U", "scroll_V", "rot_UV")
+    _flags = {"doublesided":(4,1),
+              "floor_shadow_tex":(4,2),
+              "alpha_separate":(4,4),
+
+              "wrap_U":(5,255),
+              "wrap_V":(6,255),
+              "use_alpha":(7,255),
+              "enable_alpha_test":(8,255),
+              "glass":(9,255),
+              "water":(10,255),
+              "still_water":(11,255),
+              "alpha_per_vertex":(12,255),
+
+              "invisible":(14,1),
+              "not_z_write":(14,2),
+              "has_uv":(14,4),
+              "self_lit":(14,8),
+              "no_floor_shadow":(14,16),
+              "no_delaydraw_transp":(14,32),
+              "tri_sort":(14,64),
+              "additive":(14,128),
+
+        }
+
+class group_header(record):
+    _struct = "BBBBffffffffffff"
+    _fields = matrix_field_map(4, mesh_count=0, flags1=2, flags2=3)
+    _flags = {"has_transanim":(2,1),
+              "is_a_carbody":(2,2),
+
+              "is_land":(3,4),
+              "hide_reflection":(3,8),
+              "has_hidden":(3,16),
+              }
+
+    pivot_rows = property(record.matrix_rows)
+
+class mesh_header(record):
+    _struct = "LLLBBBB"
+    _fields = {"materialid":0,
+               "face_count":1,
+               "vertex_count":2,
+               "flags1":3,
+               "flags2":4,
+               "bone_per_vertex":5,
+        }
+    _flags = {"has_weights":(3,1),
+              "has_floor_reflections":(3,2),
+              "no_outline":(3,4),
+              "is_landscape":(3,8),
+              "has_meshid":(3,16),
+              "is_compressed":(3,32),
+              "has_neckconnect":(3,64),
+              "accepts_actor_shadow":(3,128),
+
+              "has_lightmap":(4,1),
+              "is_minutehand":(4,2),
+              "is_hourhand":(4,4),
+              "static_backdrop":(4,8),
+
+              "unk_flag":(6,255),
+        }
+
+class mesh_ids(record):
+    _struct = "lll"
+    _fields = {"indexid":0,
+               "vertexid":1,
+               "skeletonid":2,
+        }
+    _wrapped = ("indexid", "skeletonid")
+
+class mesh_ranges(record):
+    _struct = "ffffffffffffff"
+    _fields = {"min_x":0,
+               "min_y":1,
+               "min_z":2,
+               "max_x":3,
+               "max_y":4,
+               "max_z":5,
+               "min_tx":6,
+               "min_ty":7,
+               "max_tx":8,
+               "max_ty":9,
+               "min_lm_x":10,
+               "min_lm_y":11,
+               "max_lm_x":12,
+               "max_lm_y":13,
+        }
+
+class compressed_vertex(record):
+    _struct = "HHHHHHHH"
+    _fields = {"x":0,
+            "y":1,
+            "z":2,
+            "nx":3,
+            "ny":4,
+            "nz":5,
+            "tx":6,
+            "ty":7,
+            }
+
+class bone_weights(record):
+    _struct = "ffffbbbb"
+    _fields = {"w0":0,
+        "w1":1,
+        "w2":2,
+        "w3":3,
+        "b0":4,
+        "b1":5,
+        "b2":6,
+        "b3":7,
+        }
+
+class skeleton_header(record):
+    _struct = "LL"
+    _fields = {"rig_id":0,
+               "bone_count":1,}
+
+class bone(record):
+    _struct = "lffffffffffff"
+    _fields = {"parent":0,
+        "m11":1,
+        "m12":2,
+        "m13":3,
+        "m21":4,
+        "m22":5,
+        "m23":6,
+        "m31":7,
+        "m32":8,
+        "m33":9,
+        "offset_x":10,
+        "offset_y":11,
+        "offset_z":12,
+        }
+
+    # bones are stored with their roll axis first
+    _row_order = (2, 0, 1, 3)
+
+    def _rows(self):
+        m = self.matrix_rows()
+        return [m[i] for i in self._row_order]
+    rows = property(_rows)
+
+class anchor(record):
+    _struct = "ffffffffffff"
+    _fields = {"m11":0,
+        "m12":1,
+        "m13":2,
+        "m21":3,
+        "m22":4,
+        "m23":5,
+        "m31":6,
+        "m32":7,
+        "m33":8,
+        "offset_x":9,
+        "offset_y":10,
+        "offset_z":11,
+        }
+
+    rows = property(record.matrix_rows)
+
+class shape(record):
+    _struct = "Lfffffffffffffff"
+    _fields = matrix_field_map(1, unknown=0, size_x=13, size_y=14, size_z=15)
+
+    center_rows = property(record.matrix_rows)
+
+    def _dimensions(self):
+        return self._value[13:16]
+    dimensions = property(_dimensions)
@@ -0,0 +1,101 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# Script copyright (C) Mark S Andrews, Nick Hudson, Glen Rickey
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+# --------------------------------------------------------------------------
+
+__author__ = ["Glen Rickey, Nick Hudson, Mark S Andrews"]
+__url__ = ("Director's Cut Modding Foundry","http://www.dcmodding.com")
+__version__ = "1.00 04-05-2009"
+__bpydoc__ = """\
+
+Msh Skeletons
+
+Keeps the armature bones msh_import.py worked out for a skeleton, so a
+rig that was imported before is rebuilt without redoing the matrix and
+bone connection work.
+
+Skeletons are keyed by their rig id (see tmConst.RIG_IDS) plus a hash
+of the bone table, and the templates are kept in a cache file in the
+temp folder.  A template is a list with one entry per bone, in skeleton
+order:
+
+    (name, parent, matrix, moves_tail, connected)
+
+matrix is the 4x4 edit bone matrix as lists of floats, moves_tail
+whether the parent's tail is moved to this bone's head and connected
+whether the bone is connected to its parent.
+
+"""
+
+
+# Import modules
+
+import os, tempfile, cPickle
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+
+CACHE_VERSION = 1
+
+def skeleton_key(skeleton):
+    '''The cache key of an msh_reader.msh_skeleton.'''
+    table = repr([(b.bone_name, b) for b in skeleton.bones])
+    return "%d-%s" % (skeleton.header.rig_id, md5(table).hexdigest())
+
+class skeleton_cache(object):
+    '''Bone templates by skeleton_key, kept in a cache file.'''
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), "msh_skeletons.cache")
+        self.path = path
+        self.templates = None
+
+    def load(self):
+        # {key: template}, empty when there is no (usable) cache file
+        try:
+            f = open(self.path, "rb")
+            try:
+                version, templates = cPickle.load(f)
+            finally:
+                f.close()
+            if version == CACHE_VERSION:
+                return templates
+        except Exception:
+            pass
+        return {}
+
+    def get(self, key):
+        if self.templates is None:
+            self.templates = self.load()
+        return self.templates.get(key)
+
+    def put(self, key, template):
+        # other imports may have added templates since this one loaded
+        self.templates = self.load()
+        self.templates[key] = template
+        try:
+            f = open(self.path, "wb")
+            try:
+                cPickle.dump((CACHE_VERSION, self.templates), f, 2)
+            finally:
+                f.close()
+        except EnvironmentError:
+            pass
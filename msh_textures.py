@@ -0,0 +1,300 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# Script copyright (C) Mark S Andrews, Nick Hudson, Glen Rickey
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+# --------------------------------------------------------------------------
+
+__author__ = ["Glen Rickey, Nick Hudson, Mark S Andrews"]
+__url__ = ("Director's Cut Modding Foundry","http://www.dcmodding.com")
+__version__ = "1.00 04-05-2009"
+__bpydoc__ = """\
+
+Msh Textures
+
+Finds the texture files named in a msh file.
+
+Textures are looked for next to the msh file, then in the textures
+folder beside the meshes folder and its lightmap, props, costumes,
+accessories, hair, makeup, people and backdrops folders.  Rather than
+testing every candidate path per image, those folders are listed once
+into a name to path index.  The index is kept in a cache file and only
+rebuilt when one of the folders has changed (its modification time
+differs), so a whole set costs a handful of stat calls on a network
+share.
+
+texture_prefetch reads the resolved files on worker threads while the
+rest of the msh file is decoded.  The data isn't kept: reading it only
+gets the file into the OS file cache, so the disk (or network) reads
+overlap with the import and Image.Load finds it there.  The DDS header
+is checked on the way, so formats Blender can't load are reported
+instead of failing in Image.Load.  Blender itself is only touched from
+the main thread.
+
+"""
+
+
+# Import modules
+
+import os, tempfile, cPickle, struct, threading, Queue
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+
+#***********************************************
+# texture folders
+#***********************************************
+
+TEXTURE_DIRS = ["lightmap","props","costumes","accessories",
+    "hair","makeup","people","backdrops"]
+
+CACHE_VERSION = 1
+
+def texture_dirs(msh_dir, texture_root):
+    '''The folders searched for textures, in search order.'''
+    dirs = [msh_dir, texture_root]
+    for dir in TEXTURE_DIRS:
+        dirs.append(os.path.join(texture_root, dir))
+    return dirs
+
+def dir_stamps(dirs):
+    # modification time of each folder, None for missing ones
+    stamps = []
+    for dir in dirs:
+        try:
+            stamps.append(os.stat(dir).st_mtime)
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+def scan_dirs(dirs):
+    '''Lists the files of dirs into a {normcase name: path} dict.  The
+    first folder holding a name wins.'''
+    names = {}
+    for dir in dirs:
+        try:
+            entries = os.listdir(dir)
+        except OSError:
+            continue
+        for entry in entries:
+            key = os.path.normcase(entry)
+            if key in names:
+                continue
+            p = os.path.join(dir, entry)
+            if os.path.isfile(p):
+                names[key] = p
+    return names
+
+#***********************************************
+# texture index
+#***********************************************
+
+class texture_index(object):
+    '''Resolves texture names to paths through a name index.
+
+    hits and misses count the names resolve() did and didn't find;
+    cached tells whether the index came from the cache file.
+    '''
+    def __init__(self, dirs, stamps, names, cached=False):
+        self.dirs = dirs
+        self.stamps = stamps
+        self.names = names
+        self.cached = cached
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, name):
+        '''The path of texture name, or None if there is none.'''
+        if os.path.dirname(name):
+            # a name with a folder in it can't be indexed, look it up
+            p = None
+            for dir in self.dirs:
+                if os.path.isfile(os.path.join(dir, name)):
+                    p = os.path.join(dir, name)
+                    break
+        else:
+            p = self.names.get(os.path.normcase(name))
+        if p:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return p
+
+    def report(self):
+        if self.cached:
+            source = "cached index"
+        else:
+            source = "new index"
+        return "textures resolved: %d found, %d missing (%s of %d files)" % (
+            self.hits, self.misses, source, len(self.names))
+
+def cache_file(dirs, cache_dir=None):
+    # one cache file per set of folders, in the temp folder by default
+    if cache_dir is None:
+        cache_dir = tempfile.gettempdir()
+    key = "\n".join([os.path.normcase(os.path.abspath(dir)) for dir in dirs])
+    return os.path.join(cache_dir, "msh_textures_%s.idx" % md5(key).hexdigest())
+
+def load_texture_index(msh_dir, texture_root, cache_dir=None):
+    '''The texture_index for a msh file in msh_dir, from the cache file
+    when none of the folders changed since it was written.'''
+    dirs = texture_dirs(msh_dir, texture_root)
+    stamps = dir_stamps(dirs)
+    path = cache_file(dirs, cache_dir)
+    try:
+        f = open(path, "rb")
+        try:
+            version, cached_stamps, names = cPickle.load(f)
+        finally:
+            f.close()
+        if version == CACHE_VERSION and cached_stamps == stamps:
+            return texture_index(dirs, stamps, names, True)
+    except Exception:
+        # missing, stale or unreadable cache, rebuild it
+        pass
+
+    names = scan_dirs(dirs)
+    try:
+        f = open(path, "wb")
+        try:
+            cPickle.dump((CACHE_VERSION, stamps, names), f, 2)
+        finally:
+            f.close()
+    except EnvironmentError:
+        pass
+    return texture_index(dirs, stamps, names)
+
+#***********************************************
+# texture prefetch
+#***********************************************
+
+READ_CHUNK = 1 << 20
+
+# DDS formats Blender 2.49 loads, "" being uncompressed
+DDS_FORMATS = ("", "DXT1", "DXT3", "DXT5")
+
+def dds_info(header):
+    '''(width, height, mipmaps, fourcc) from the first 128 bytes of a
+    DDS file, None if it isn't one.'''
+    if len(header) < 128 or header[:4] != "DDS ":
+        return None
+    size, flags, height, width = struct.unpack_from("<LLLL", header, 4)
+    mipmaps = struct.unpack_from("<L", header, 28)[0]
+    fourcc = header[84:88].rstrip("\x00")
+    return width, height, mipmaps, fourcc
+
+class texture_file(object):
+    '''One texture of the image table, filled in by a prefetch worker.
+
+    path is None for textures that weren't found, error holds the
+    message if the file couldn't be read, info the dds_info() of DDS
+    files.
+    '''
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.info = None
+        self.error = None
+        self.done = threading.Event()
+
+    def fetch(self):
+        try:
+            f = open(self.path, "rb")
+            try:
+                data = f.read(READ_CHUNK)
+                self.info = dds_info(data[:128])
+                # read the rest only to have it in the OS file cache for
+                # Image.Load, the data itself is dropped
+                while len(data) == READ_CHUNK:
+                    data = f.read(READ_CHUNK)
+            finally:
+                f.close()
+        except EnvironmentError, e:
+            self.error = str(e)
+
+    def unsupported(self):
+        '''Why Blender can't load this texture, None if it can (or it
+        wasn't read).'''
+        if self.path is None or self.error:
+            return None
+        if self.info is None:
+            if self.name.lower().endswith(".dds"):
+                return "not a DDS file"
+            return None
+        if self.info[3] not in DDS_FORMATS:
+            return "unsupported DDS format %r" % self.info[3]
+        return None
+
+class texture_prefetch(object):
+    '''Reads the textures of an image table on a pool of threads.
+
+    start() is given the image names as soon as they are decoded and
+    returns straight away; get() waits for one texture to be read.
+    Textures are resolved through index (a texture_index).  Blender 2.49
+    loads DDS files (DXT compressed too) itself, so the workers only
+    read the DDS headers and warm the OS file cache with the rest.
+    '''
+    def __init__(self, index, workers=4):
+        self.index = index
+        self.workers = workers
+        self.files = []
+        self.jobs = Queue.Queue()
+        self.threads = []
+
+    def start(self, names):
+        for name in names:
+            tf = texture_file(name, self.index.resolve(name))
+            self.files.append(tf)
+            if tf.path:
+                self.jobs.put(tf)
+            else:
+                tf.done.set()
+        for i in range(min(self.workers, self.jobs.qsize())):
+            t = threading.Thread(target=self.work)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        while True:
+            try:
+                tf = self.jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                tf.fetch()
+            finally:
+                tf.done.set()
+
+    def get(self, imageid):
+        '''The texture_file of image imageid, once it has been read.'''
+        tf = self.files[imageid]
+        tf.done.wait()
+        return tf
+
+    def stop(self):
+        '''Drops textures not read yet and waits for the workers.'''
+        try:
+            while True:
+                self.jobs.get_nowait().done.set()
+        except Queue.Empty:
+            pass
+        for t in self.threads:
+            t.join()
+        self.threads = []